@@ -3,17 +3,34 @@
 This module tries to export `root_agent` from `agent.py` in a way that
 works when the package is imported normally and when files are executed
 or tested directly (pytest imports modules by path).
+
+`root_agent` is resolved on first attribute access (PEP 562) so importing
+the package does not build the agent until it is actually needed.
 """
 
-try:
-	# If imported as a package (preferred)
-	from .agent import root_agent  # type: ignore
-except Exception:
-	# Allow importing the module directly (e.g., `from agent import root_agent`)
-	try:
-		from agent import root_agent  # type: ignore
-	except Exception:
-		# If neither import works, provide a placeholder to avoid import errors
-		root_agent = None
+from importlib import import_module
+from importlib.util import find_spec
+
+
+def _agent_module_name():
+	# Prefer the package-relative module, then a top-level `agent` module
+	# (e.g. when files are imported by path). Checking with find_spec avoids
+	# raising and catching ImportError on the normal path.
+	if __package__ and find_spec(f"{__package__}.agent") is not None:
+		return f"{__package__}.agent"
+	if find_spec("agent") is not None:
+		return "agent"
+	return None
+
+
+def __getattr__(name):
+	if name != "root_agent":
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	module_name = _agent_module_name()
+	# If no agent module can be found, provide a placeholder to avoid import errors
+	root_agent = import_module(module_name).root_agent if module_name else None
+	globals()["root_agent"] = root_agent
+	return root_agent
+
 
 __all__ = ["root_agent"]
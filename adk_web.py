@@ -1,7 +1,12 @@
 """
 ADK Web Command Representation - Flask Web App
+
+In production this app is served by gunicorn (see the Dockerfile). Set
+FLASK_DEV=1 to run it with the Flask development server instead.
 """
 
+import os
+
 from flask import Flask
 
 app = Flask(__name__)
@@ -10,5 +15,14 @@ app = Flask(__name__)
 def index():
     return "ADK Web berjalan di Cloud Run!"
 
+@app.route('/health')
+def health():
+    return "ok"
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    if os.getenv("FLASK_DEV", "").lower() in ("1", "true", "yes"):
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
+    else:
+        raise SystemExit(
+            "Use gunicorn to serve adk_web:app, or set FLASK_DEV=1 for the development server."
+        )